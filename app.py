@@ -4,9 +4,21 @@ import geopandas as gpd
 import folium
 from streamlit_folium import folium_static
 import logging
+import hashlib
+import contextlib
+import os
+import tempfile
+import time
+import sqlite3
+import threading
+import orjson
+import requests
+from urllib.parse import urlencode, urlsplit
+from concurrent.futures import ThreadPoolExecutor
 from geopy.geocoders import Nominatim
-from shapely.geometry import Point
-from shapely.ops import nearest_points
+from geopy.extra.rate_limiter import RateLimiter
+import shapely
+from shapely.geometry import Point, box
 import pyproj
 
 # Configure logging
@@ -18,37 +30,165 @@ DEFAULT_CENTER = [39.0458, -76.6413]  # Baltimore coordinates
 HIGH_RISK_THRESHOLD = 0.7
 CRS_WGS84 = "EPSG:4326"  # WGS84 coordinate system
 CRS_PROJECTED = "EPSG:26985"  # Projected CRS for Maryland
+SIMPLIFY_TOLERANCE = 0.0001  # Degrees (~10 m); applied only to the copies handed to folium
+COORD_PRECISION = 1e-6  # Degrees (~11 cm); coordinates are snapped to this grid at load
+ADDRESS_ZOOM = 15  # A 700 px map at this zoom spans ~0.03 deg of longitude, inside the clip box
+VIEWPORT_HALF_SIZE = 0.02  # Degrees around the searched address to render
+DOWNLOAD_TIMEOUT = 60  # Seconds per layer download
+CACHE_TTL = 3600  # Seconds before cached downloads are refreshed
+CACHE_DIR = tempfile.gettempdir()  # Where parsed layers are stored as GeoParquet
+GEOCODE_CACHE_PATH = os.path.join(CACHE_DIR, "stopskeeters_geocode.sqlite")
+GEOCODE_CACHE_BUSY_TIMEOUT = 10  # Seconds to wait on a lock held by another Streamlit process
+GEOCODE_MISS_TTL = 600  # Seconds before an address Nominatim could not find is retried
+GEOCODE_TIMEOUT = 15  # Seconds; geopy's 1 s default causes spurious failures
+GEOCODE_MIN_DELAY = 1  # Seconds between Nominatim requests, per its usage policy
+NOMINATIM_URL = os.environ.get("NOMINATIM_URL")  # Optional self-hosted instance, e.g. "http://localhost:8080"
 
-# Data sources
+# Data sources (ArcGIS REST query endpoints; see build_query_url for parameters)
 DATA_SOURCES = {
-    "parcels": "https://geodata.md.gov/imap/rest/services/PlanningCadastre/MD_ParcelBoundaries/MapServer/0/query?outFields=*&where=1%3D1&f=geojson",
-    "roads": "https://services.arcgis.com/njFNhDsUCentVYJW/arcgis/rest/services/MDOT_Know_Your_Roads/FeatureServer/0/query?outFields=*&where=1%3D1&f=geojson"
+    "parcels": "https://geodata.md.gov/imap/rest/services/PlanningCadastre/MD_ParcelBoundaries/MapServer/0/query",
+    "roads": "https://services.arcgis.com/njFNhDsUCentVYJW/arcgis/rest/services/MDOT_Know_Your_Roads/FeatureServer/0/query"
 }
+QUERY_OUT_FIELDS = "OBJECTID"  # No other attributes are used by the app
 WETLANDS_WMS_URL = "https://geodata.md.gov/imap/services/Hydrology/MD_Wetlands/MapServer/WMSServer?"
 WETLANDS_LAYER_NAME = '0'
 
-@st.cache_data
-def load_data(source, data_type="geojson"):
+def cache_path_for(source):
+    digest = hashlib.sha256(source.encode("utf-8")).hexdigest()  # Stable across restarts, unlike hash()
+    return os.path.join(CACHE_DIR, f"stopskeeters_{digest}.parquet")
+
+def write_cache(gdf, cache_path):
+    # Write to a temp file and rename so readers never see a half-written Parquet file
+    fd, tmp_path = tempfile.mkstemp(dir=CACHE_DIR, suffix=".parquet.tmp")
+    os.close(fd)
+    try:
+        gdf.to_parquet(tmp_path, compression="zstd")
+        os.replace(tmp_path, cache_path)
+    except Exception as e:
+        logger.warning(f"Could not cache to {cache_path}: {e}")  # Cache is best-effort
+        with contextlib.suppress(FileNotFoundError):
+            os.remove(tmp_path)
+
+def is_cache_fresh(cache_path):
+    return os.path.exists(cache_path) and time.time() - os.path.getmtime(cache_path) < CACHE_TTL
+
+def read_cache(cache_path):
+    if not is_cache_fresh(cache_path):
+        return None
     try:
-        if data_type == "geojson":
-            gdf = gpd.read_file(source)
-            return gdf
+        return gpd.read_parquet(cache_path)
     except Exception as e:
-        logger.error(f"Error loading {source}: {e}")
-        st.error(f"Failed to load {source}.  Check the URL and your internet connection.")
-        return gpd.GeoDataFrame()  # Return empty GeoDataFrame to avoid further errors
+        logger.warning(f"Discarding unreadable cache {cache_path}: {e}")  # Fall through to a fresh download
+        with contextlib.suppress(FileNotFoundError):
+            os.remove(cache_path)
+        return None
+
+def parse_geojson(content):
+    # orjson + shapely.from_geojson avoids Fiona's temp-file round trip and per-feature Python objects
+    doc = orjson.loads(content)
+    if "error" in doc:  # ArcGIS reports query errors as JSON with a 200 status
+        raise ValueError(doc["error"])
+    features = doc.get("features", [])
+    geometries = shapely.from_geojson(
+        [orjson.dumps(f["geometry"]) if f.get("geometry") else None for f in features]
+    )
+    properties = pd.DataFrame([f.get("properties") or {} for f in features])
+    return gpd.GeoDataFrame(properties, geometry=geometries, crs=CRS_WGS84)  # GeoJSON is always WGS84
+
+def load_data(source, data_type="geojson"):
+    # Raises on failure; load_all_data reports it. In-process memoization is init_layer's job.
+    if data_type == "geojson":
+        cache_path = cache_path_for(source)
+        cached = read_cache(cache_path)
+        if cached is not None:
+            return cached
+        response = requests.get(source, timeout=DOWNLOAD_TIMEOUT)
+        response.raise_for_status()
+        gdf = parse_geojson(response.content)  # Already WGS84, so no reprojection at render time
+        gdf['geometry'] = shapely.set_precision(gdf.geometry.values, COORD_PRECISION)  # Shorter GeoJSON numbers
+        write_cache(gdf, cache_path)
+        return gdf
+
+def build_query_url(base_url):
+    params = {
+        "where": "1=1",
+        "outFields": QUERY_OUT_FIELDS,
+        "outSR": 4326,
+        "maxAllowableOffset": COORD_PRECISION,  # Sub-metre: this copy also feeds nearest-parcel search
+        "f": "geojson",
+    }
+    return f"{base_url}?{urlencode(params)}"
+
+@st.cache_resource
+def init_layer_build_times():
+    return {}  # source -> when init_layer last built it, so load_all_data knows what is in memory
+
+@st.cache_resource(ttl=CACHE_TTL)
+def init_layer(source, project=False):
+    # One indexed copy per source, shared by all sessions and rebuilt after CACHE_TTL.
+    # Callers must not mutate the frames; cache_resource hands out the same objects.
+    layer = {"data": load_data(source), "projected": None}
+    layer["display"] = simplify_for_display(layer["data"])  # What create_map clips and serializes
+    _ = layer["data"].sindex  # Build the STRtrees now; GeoPandas keeps them on the frame
+    _ = layer["display"].sindex
+    if project:  # Built together so rows always line up with "data"
+        layer["projected"] = layer["data"].to_crs(CRS_PROJECTED)
+        _ = layer["projected"].sindex
+    init_layer_build_times()[source] = time.time()  # Only after a successful build
+    return layer
+
+def needs_download(source):
+    built_at = init_layer_build_times().get(source)
+    if built_at is not None and time.time() - built_at < CACHE_TTL:
+        return False  # init_layer will answer from memory
+    return not is_cache_fresh(cache_path_for(source))
+
+def load_all_data(sources):
+    urls = {name: build_query_url(url) for name, url in sources.items()}
+    pending = [url for url in urls.values() if needs_download(url)]
+    if len(pending) > 1:
+        # Downloads are I/O-bound and hit different hosts, so warm the Parquet cache concurrently.
+        # Workers only call load_data, which uses no Streamlit APIs; failures resurface below.
+        with ThreadPoolExecutor(max_workers=len(pending)) as executor:
+            for url in pending:
+                executor.submit(load_data, url)
+    layers = {}
+    for name, url in urls.items():
+        try:
+            layers[name] = init_layer(url, project=(name == "parcels"))
+        except Exception as e:
+            logger.error(f"Error loading {url}: {e}")
+            st.error(f"Failed to load {name} from {url}.  Check the URL and your internet connection.")
+            layers[name] = None  # Callers treat a missing layer as not loaded
+    return layers
+
+def simplify_for_display(gdf):
+    display_gdf = gdf[['geometry']].copy()  # Attributes are never shown, so don't inline them in the page
+    display_gdf['geometry'] = display_gdf.geometry.simplify(SIMPLIFY_TOLERANCE, preserve_topology=True)
+    return display_gdf
+
+def clip_to_viewport(gdf, center_point):
+    lat, lon = center_point
+    viewport = box(lon - VIEWPORT_HALF_SIZE, lat - VIEWPORT_HALF_SIZE,
+                   lon + VIEWPORT_HALF_SIZE, lat + VIEWPORT_HALF_SIZE)
+    return gdf.iloc[gdf.sindex.query(viewport, predicate='intersects')]  # Layers are in WGS84
 
 def create_map(center_point=None, parcels=gpd.GeoDataFrame(), wetlands_wms_url=None,
                roads=gpd.GeoDataFrame(), highlighted_parcel=None):
-    zoom = 12 if center_point else 10
+    zoom = ADDRESS_ZOOM if center_point else 10
     m = folium.Map(
         location=center_point or DEFAULT_CENTER,
         zoom_start=zoom,
-        tiles='CartoDB positron'
+        tiles='CartoDB positron',
+        prefer_canvas=True  # Draw vector layers on one canvas instead of an SVG path per feature
     )
 
+    if center_point:  # Only render what is around the searched address
+        parcels = clip_to_viewport(parcels, center_point) if not parcels.empty else parcels
+        roads = clip_to_viewport(roads, center_point) if not roads.empty else roads
+
     if not parcels.empty:
-        folium.GeoJson(parcels.to_crs(CRS_WGS84), name="Parcels").add_to(m) # Project parcels to WGS84
+        folium.GeoJson(parcels, name="Parcels").add_to(m) # Already simplified by init_layer
 
     if wetlands_wms_url:
         folium.WmsTileLayer(
@@ -62,11 +202,11 @@ def create_map(center_point=None, parcels=gpd.GeoDataFrame(), wetlands_wms_url=N
         ).add_to(m)
 
     if not roads.empty:
-        folium.GeoJson(roads.to_crs(CRS_WGS84), name="Roads").add_to(m) # Project roads to WGS84
+        folium.GeoJson(roads, name="Roads").add_to(m) # Already simplified by init_layer
 
     if highlighted_parcel is not None and not highlighted_parcel.empty: #Check if it's empty
         folium.GeoJson(
-            highlighted_parcel.to_crs(CRS_WGS84),  # Project highlighted parcel to WGS84
+            highlighted_parcel,
             style_function=lambda x: {'fillColor': 'red', 'color': 'red', 'fillOpacity': 0.5} # Add fillOpacity
         ).add_to(m)
 
@@ -77,22 +217,56 @@ def create_map(center_point=None, parcels=gpd.GeoDataFrame(), wetlands_wms_url=N
 def calculate_risk(parcel):
     return 0.5  # Placeholder implementation - replace with your actual risk calculation
 
+@st.cache_resource
+def init_geocode_cache():
+    conn = sqlite3.connect(GEOCODE_CACHE_PATH, check_same_thread=False,  # Shared by all sessions
+                           timeout=GEOCODE_CACHE_BUSY_TIMEOUT)
+    conn.execute("CREATE TABLE IF NOT EXISTS geocode_cache(addr TEXT PRIMARY KEY, lat REAL, lon REAL, cached_at REAL)")
+    columns = {row[1] for row in conn.execute("PRAGMA table_info(geocode_cache)")}
+    if "cached_at" not in columns:  # Cache files created before misses were timestamped
+        with contextlib.suppress(sqlite3.OperationalError):  # Another process may have just added it
+            conn.execute("ALTER TABLE geocode_cache ADD COLUMN cached_at REAL")
+    return conn, threading.Lock()  # Session threads must serialize use of the shared connection
+
+@st.cache_resource
+def init_geocoder():
+    if NOMINATIM_URL:  # Self-hosted instance: no public usage-policy rate limit
+        url = urlsplit(NOMINATIM_URL if "://" in NOMINATIM_URL else f"http://{NOMINATIM_URL}")
+        geolocator = Nominatim(user_agent="mosquito_control_app", timeout=GEOCODE_TIMEOUT,
+                               domain=url.netloc + url.path.rstrip("/"), scheme=url.scheme)
+        return geolocator.geocode
+    geolocator = Nominatim(user_agent="mosquito_control_app", timeout=GEOCODE_TIMEOUT)
+    return RateLimiter(geolocator.geocode, min_delay_seconds=GEOCODE_MIN_DELAY, swallow_exceptions=False)
+
 def geocode_address(address):
-    geolocator = Nominatim(user_agent="mosquito_control_app")
+    conn, lock = init_geocode_cache()
+    address = address.strip()
     try:
-        location = geolocator.geocode(address)
-        return [location.latitude, location.longitude] if location else None
+        with lock:
+            row = conn.execute("SELECT lat, lon, cached_at FROM geocode_cache WHERE addr = ?", [address]).fetchone()
+        if row and row[0] is not None:
+            return [row[0], row[1]]
+        if row and row[2] is not None and time.time() - row[2] < GEOCODE_MISS_TTL:
+            return None  # Recent miss (NULL coordinates); older ones are retried below
+        location = init_geocoder()(address)
+        coords = [location.latitude, location.longitude] if location else [None, None]
+        with lock, conn:
+            conn.execute("INSERT OR REPLACE INTO geocode_cache VALUES (?, ?, ?, ?)", [address, *coords, time.time()])
+        return coords if location else None
     except Exception as e:
         logger.error(f"Geocoding error: {e}")
         st.error("Geocoding failed. Please check your address and try again.")
         return None
 
-def find_nearest_parcel(point, parcels):
+@st.cache_resource
+def init_transformer():
+    return pyproj.Transformer.from_crs(CRS_WGS84, CRS_PROJECTED, always_xy=True)  # Shared across reruns
+
+def find_nearest_parcel(point, parcels, parcels_proj):
     try:
-        parcels_proj = parcels.to_crs(CRS_PROJECTED)
-        point_proj = gpd.GeoSeries([point], crs=CRS_WGS84).to_crs(CRS_PROJECTED)[0]
-        nearest = nearest_points(point_proj, parcels_proj.unary_union)
-        nearest_parcel = parcels_proj[parcels_proj.geometry == nearest[1]].to_crs(CRS_WGS84) #Project back
+        point_proj = Point(init_transformer().transform(point.x, point.y))
+        nearest_idx = parcels_proj.sindex.nearest(point_proj, return_all=False)[1][0]  # STRtree lookup, no union
+        nearest_parcel = parcels.iloc[[nearest_idx]]  # Same rows as parcels_proj, already in WGS84
         return nearest_parcel
     except Exception as e:
         logger.error(f"Error finding nearest parcel: {e}")
@@ -101,17 +275,23 @@ def find_nearest_parcel(point, parcels):
 # Streamlit App
 st.title("Mosquito Control Dashboard")
 
+show_wetlands = st.sidebar.checkbox("Show wetlands", value=True)
+show_roads = st.sidebar.checkbox("Show roads", value=False)  # Only downloaded once switched on
+wetlands_wms_url = WETLANDS_WMS_URL if show_wetlands else None
+
 with st.spinner("Loading data..."):
-    parcels = load_data(DATA_SOURCES["parcels"])
-    roads = load_data(DATA_SOURCES["roads"])
+    layers = load_all_data({name: url for name, url in DATA_SOURCES.items() if name != "roads" or show_roads})
+    parcels_layer = layers["parcels"]
+    roads_display = layers["roads"]["display"] if layers.get("roads") else gpd.GeoDataFrame()
 
-if not parcels.empty and not roads.empty: # Check if data loaded successfully
+if parcels_layer and not parcels_layer["data"].empty: # Check if required data loaded successfully
+    parcels, parcels_proj = parcels_layer["data"], parcels_layer["projected"]
     address = st.text_input("Enter an address:")
     if address:
         center_point = geocode_address(address)
         if center_point:
             point = Point(center_point[1], center_point[0])  # Shapely Point (lon, lat)
-            nearest_parcel = find_nearest_parcel(point, parcels)
+            nearest_parcel = find_nearest_parcel(point, parcels, parcels_proj)
 
             if not nearest_parcel.empty:
                 risk_score = calculate_risk(nearest_parcel)
@@ -119,9 +299,9 @@ if not parcels.empty and not roads.empty: # Check if data loaded successfully
 
                 map_obj = create_map(
                     center_point=center_point,
-                    parcels=parcels,
-                    wetlands_wms_url=WETLANDS_WMS_URL,
-                    roads=roads,
+                    parcels=parcels_layer["display"],
+                    wetlands_wms_url=wetlands_wms_url,
+                    roads=roads_display,
                     highlighted_parcel=nearest_parcel
                 )
                 folium_static(map_obj)
@@ -130,7 +310,8 @@ if not parcels.empty and not roads.empty: # Check if data loaded successfully
         else:
             st.error("Address not found.")
     else:
-        map_obj = create_map(parcels=parcels, wetlands_wms_url=WETLANDS_WMS_URL, roads=roads)
+        map_obj = create_map(parcels=parcels_layer["display"], wetlands_wms_url=wetlands_wms_url,
+                             roads=roads_display)
         folium_static(map_obj)
 else:
     st.error("Failed to load required data.  The app cannot run.")